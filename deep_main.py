@@ -3,6 +3,7 @@ from deep_q_learning import *
 
 
 if __name__ == '__main__':
+    configure_session()
     cartpole_env = gym.make("CartPole-v1").env
 
     agent = DQNAgent(env=cartpole_env)
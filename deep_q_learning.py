@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
-import random
 import numpy as np
 from collections import deque
 from tqdm import tqdm
 import datetime
-import statistics
 import time
 import gym
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 tf.get_logger().setLevel(tf.logging.ERROR)
 
+from keras import backend as K
 from keras.models import Sequential
 from keras.layers import Dense
 from keras.optimizers import Adam
@@ -19,7 +19,46 @@ from keras.optimizers import Adam
 import warnings
 warnings.filterwarnings("ignore")
 
-__all__ = ['DQNAgent']
+__all__ = ['DQNAgent', 'configure_session']
+
+
+_session_options = None  # options of the Keras session set by 'configure_session'
+
+
+def configure_session(jit_compile=True, mixed_precision=False):
+    """
+    Set the Keras backend session once per process, before creating any agent
+    (replacing the session later would drop the variables of the agents already created).
+    The first agent calls it with the default options when it was not called before,
+    and all agents follow its 'mixed_precision' option.
+
+    :param jit_compile: auto-cluster the graph with XLA. In TF1 this fuses ops on GPU only,
+                        on CPU it also needs the env variable TF_XLA_FLAGS=--tf_xla_cpu_global_jit
+    :param mixed_precision: compute the network in float16 where supported (GPU with Tensor Cores).
+                            The TF1 graph rewrite also runs the output layer in float16, so the q-values
+                            and targets lose precision for large returns
+    """
+    global _session_options
+
+    config = tf.ConfigProto()
+    if jit_compile:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    if mixed_precision:
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    K.set_session(tf.Session(config=config))
+
+    _session_options = {'jit_compile': jit_compile, 'mixed_precision': mixed_precision}
+
+
+def _huber_loss(y_true, y_pred):
+    """
+    Huber loss (delta = 1) in Keras form: one value per sample, not added to the graph's loss collection
+    """
+    losses = tf.losses.huber_loss(y_true, y_pred,
+                                  delta=1.0,
+                                  loss_collection=None,
+                                  reduction=tf.losses.Reduction.NONE)
+    return K.mean(losses, axis=-1)
 
 
 class DQNAgent:
@@ -34,8 +73,11 @@ class DQNAgent:
                  epsilon_decay=0.995,
                  learning_rate=0.001,
                  experience_replay_size=100000,
+                 experience_replay_dtype=None,
                  steps_update_target_model=32,
-                 num_layers=5):
+                 num_layers=2,
+                 hidden_units=128,
+                 steps_log_scalars=100):
         """
         :param env: Open AI env
         :param gamma: discount factor 𝛾,
@@ -44,13 +86,17 @@ class DQNAgent:
         :param epsilon_decay: decay rate for decaying epsilon-greedy probability
         :param learning_rate: learning rate for neural network optimizer
         :param experience_replay_size: experience replay size
+        :param experience_replay_dtype: dtype of the states stored in the experience replay,
+                                        by default float16 if the observation bounds fit in it, float32 otherwise
         :param steps_update_target_model: num of steps to update the target model (𝜃− <- 𝜃)
-        :param num_layers: number of layers to the model (could be 3 or 5)
+        :param num_layers: number of hidden layers to the model
+        :param hidden_units: number of units in each hidden layer
+        :param steps_log_scalars: num of steps between logging the step loss and epsilon
         """
         self.env = env
         self.state_size = env.observation_space.shape[0]
         self.action_size = env.action_space.n
-        self.experience_replay = deque(maxlen=experience_replay_size)
+        self.experience_replay_size = experience_replay_size
         self.gamma = gamma
         self.epsilon = epsilon
         self.min_epsilon = min_epsilon
@@ -58,14 +104,50 @@ class DQNAgent:
         self.learning_rate = learning_rate
         self.steps_update_target_model = steps_update_target_model
         self.num_layers = num_layers
+        self.hidden_units = hidden_units
+        self.steps_log_scalars = steps_log_scalars
+
+        # the session decides on mixed precision, so the optimizer adds loss scaling only when the rewrite runs
+        if _session_options is None:
+            configure_session()
+        self.mixed_precision = _session_options['mixed_precision']
+
+        if experience_replay_dtype is None:
+            experience_replay_dtype = self._default_experience_replay_dtype()
+
+        # experience replay as a ring buffer, one pre-allocated array per transition field.
+        # each observation is stored once: the transition in slot i goes from _obs[i] to _obs[i+1]
+        self._obs = np.empty((experience_replay_size, self.state_size), dtype=experience_replay_dtype)
+        self._buf_a = np.empty(experience_replay_size, dtype=np.int32)
+        self._buf_r = np.empty(experience_replay_size, dtype=np.float32)
+        self._buf_d = np.empty(experience_replay_size, dtype=np.float32)
+        self._buf_valid = np.zeros(experience_replay_size, dtype=np.bool_)  # slot holds a full transition
+        self._idx = 0  # position of the current observation in the experience replay
+        self._size = 0  # number of slots used in the experience replay
+        self._num_transitions = 0  # number of valid transitions in the experience replay
+        self._next_state_pending = False  # current observation is the next state of a stored transition
+
         self.q_value_model = self._build_model()  # predicting the q-value (using parameters 𝜃)
         self.target_model = self._build_model()  # computing the targets (using an older set of parameters 𝜃−)
+        self._train_step = self._build_train_step()
+        self._sync_target = self._build_sync_target()
+        self._greedy_action = self._build_greedy_action()
 
         self._log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        # self._tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=self._log_dir, histogram_freq=1)
         self._file_writer = tf.summary.FileWriter(self._log_dir + "/metrics")
         # self._file_writer.set_as_default()
         self._last_100_rewards = deque(maxlen=100)
+        self._last_100_rewards_sum = 0  # running sum of '_last_100_rewards'
+
+    def _default_experience_replay_dtype(self):
+        """
+        float16 for observations bounded within its range (it saturates to inf above it), float32 otherwise
+        """
+        observation_space = self.env.observation_space
+        float16_info = np.finfo(np.float16)
+        if np.all(observation_space.low >= float16_info.min) and np.all(observation_space.high <= float16_info.max):
+            return np.float16
+        return np.float32
 
     def _build_model(self):
         """
@@ -74,81 +156,168 @@ class DQNAgent:
         and output the predicted q-value of each action for that state.
         """
         model = Sequential()
-        model.add(Dense(units=32, input_dim=self.state_size, activation='relu'))
-        model.add(Dense(units=32, activation='relu'))
-        model.add(Dense(units=32, activation='relu'))
-        if self.num_layers == 5:
-            model.add(Dense(units=32, activation='relu'))
-            model.add(Dense(units=32, activation='relu'))
+        model.add(Dense(units=self.hidden_units, input_dim=self.state_size, activation='relu'))
+        for _ in range(self.num_layers - 1):
+            model.add(Dense(units=self.hidden_units, activation='relu'))
         model.add(Dense(units=self.action_size, activation='linear'))
-        model.compile(loss='mse', optimizer=Adam(lr=self.learning_rate))
+        model.compile(loss=_huber_loss, optimizer=self._build_optimizer())
         return model
 
-    def _sample_action(self, state):
+    def _build_train_step(self):
+        """
+        Graph function performing a whole training step on a minibatch in a single run:
+        computing the targets y = r + 𝛾 * max_a' Q(s', a'; 𝜃−), and a gradient descent step on the q-values
+        of the taken actions. Terminal transitions (done = 1) get their reward times 'terminal_reward_weight'.
+        It is built once, so each step reuses the same graph instead of going through the Keras training loop.
+        """
+        states = self.q_value_model.input
+        actions = K.placeholder(shape=(None,), dtype='int32')
+        rewards = K.placeholder(shape=(None,))
+        next_states = self.target_model.input
+        dones = K.placeholder(shape=(None,))
+        terminal_reward_weight = K.placeholder(shape=())
+
+        max_next_q_values = K.max(self.target_model.output, axis=1)
+        non_terminal_targets = rewards + self.gamma * max_next_q_values
+        terminal_targets = rewards * terminal_reward_weight
+        # select rather than blend: the next state of a terminal transition is the next episode's initial state,
+        # and its (possibly overflowing) q-value must not leak into the target as 0 * inf
+        targets = K.stop_gradient(tf.where(dones > 0.5, terminal_targets, non_terminal_targets))
+
+        q_values = K.sum(self.q_value_model.output * K.one_hot(actions, self.action_size), axis=1)
+        loss = tf.losses.huber_loss(targets, q_values,
+                                    delta=1.0,
+                                    loss_collection=None,
+                                    reduction=tf.losses.Reduction.MEAN)
+        updates = self.q_value_model.optimizer.get_updates(loss=loss, params=self.q_value_model.trainable_weights)
+        return K.function([states, actions, rewards, next_states, dones, terminal_reward_weight],
+                          [loss],
+                          updates=updates)
+
+    def _build_sync_target(self):
+        """
+        Graph function updating the target network (𝜃− <- 𝜃) by assigning the variables on the device,
+        without copying the weights through NumPy.
+        """
+        updates = [K.update(target_weight, weight)
+                   for target_weight, weight in zip(self.target_model.weights, self.q_value_model.weights)]
+        return K.function([], [], updates=updates)
+
+    def _build_greedy_action(self):
+        """
+        Graph function returning the action with max q-value of each state,
+        so only the action index is copied back from the device.
+        """
+        states = self.q_value_model.input
+        return K.function([states], [K.argmax(self.q_value_model.output, axis=-1)])
+
+    def _build_optimizer(self):
+        """
+        Adam optimizer for the network.
+        With mixed precision, the graph rewrite casts the network to float16 (the output layer included)
+        and adds dynamic loss scaling.
+        """
+        if not self.mixed_precision:
+            return Adam(lr=self.learning_rate)
+
+        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        return tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
+
+    def _sample_action(self, state, epsilon_roll, random_action):
         """
         choose an action with decaying 𝜀-greedy method, given state 'state'
+        :param epsilon_roll: uniform random number in [0, 1) compared against epsilon
+        :param random_action: action to take when exploring
+        """
+        if epsilon_roll < self.epsilon:
+            return int(random_action)
+
+        return int(self._greedy_action([state[None, :]])[0][0])  # return action with max q-value
+
+    def _store_state(self, state):
+        """
+        store the initial state of an episode in the experience replay
+        """
+        # keep the next state of a transition that was cut by 'steps_per_episode' instead of overwriting it
+        if self._next_state_pending:
+            self._advance()
+
+        self._obs[self._idx] = state
+        self._invalidate_slot()
+        self._size = max(self._size, self._idx + 1)
+
+    def _store_transition(self, action, reward, next_state, done):
+        """
+        store transition from the current observation in the experience replay,
+        overwriting the oldest one when it is full
+        """
+        self._buf_a[self._idx] = action
+        self._buf_r[self._idx] = reward
+        self._buf_d[self._idx] = done
+        self._buf_valid[self._idx] = True
+        self._num_transitions += 1
+
+        self._advance()
+        self._obs[self._idx] = next_state
+        self._invalidate_slot()
+        self._size = max(self._size, self._idx + 1)
+        self._next_state_pending = not done
+
+    def _invalidate_slot(self):
+        """
+        mark the current slot as holding no transition, dropping the transition it held before
         """
-        if random.uniform(0, 1) < self.epsilon:
-            return self.env.action_space.sample()
+        if self._buf_valid[self._idx]:
+            self._buf_valid[self._idx] = False
+            self._num_transitions -= 1
 
-        q_values = self.q_value_model.predict(state)[0]  # predict q-value given state
-        return np.argmax(q_values)  # return action with max q-value
+    def _advance(self):
+        """
+        move to the next slot of the experience replay
+        """
+        self._idx = (self._idx + 1) % self.experience_replay_size
+        self._next_state_pending = False
 
     def _sample_batch(self, batch_size):
         """
         sample a minibatch randomly from the experience_replay in 'batch_size' size
+        :return: states, actions, rewards, next states and dones of the minibatch
         """
-        return random.sample(self.experience_replay, batch_size)
+        idx = np.random.randint(0, self._size, batch_size)
+
+        # resample slots that hold no transition (current observation, end of a cut episode)
+        invalid = ~self._buf_valid[idx]
+        while invalid.any():
+            idx[invalid] = np.random.randint(0, self._size, np.count_nonzero(invalid))
+            invalid = ~self._buf_valid[idx]
+
+        next_idx = (idx + 1) % self.experience_replay_size
+        states = self._obs[idx].astype(np.float32)
+        next_states = self._obs[next_idx].astype(np.float32)
+        return states, self._buf_a[idx], self._buf_r[idx], next_states, self._buf_d[idx]
 
     def _replay(self, batch_size, total_step_number, step):
         """
         sample random minibatch, update y, and perform gradient descent step
         """
         # wait for 'experience_replay' to contain at least 'batch_size' transitions
-        if len(self.experience_replay) <= batch_size:
+        if self._num_transitions <= batch_size:
             return
 
-        minibatch = self._sample_batch(batch_size)
-
-        states_in_batch = []
-        target_in_batch = []
-        for state, action, reward, next_state, done in minibatch:
-            if done and step < 500:  # for terminal transition
-                target = 0
-            elif done:
-                target = reward
-            else:  # for non-terminal transition
-                target = (reward + self.gamma*np.max(self.target_model.predict(next_state)[0]))
-
-            # update y
-            target_f = self.q_value_model.predict(state)
-            target_f[0][action] = target
-
-            states_in_batch.append(state[0])
-            target_in_batch.append(target_f[0])
-
-        # perform a gradient descent for entire batch
-        fit_result = self.q_value_model.fit(np.array(states_in_batch),
-                                            np.array(target_in_batch),
-                                            batch_size=batch_size,
-                                            epochs=1,
-                                            # epochs=step_number + 1,
-                                            # initial_epoch=step_number,
-                                            verbose=0,
-                                            # callbacks=[self._tensorboard_callback]
-                                            )
-        loss = fit_result.history['loss'][0]
-        self._log_scalar('step loss', value=loss, step=total_step_number)
+        states, actions, rewards, next_states, dones = self._sample_batch(batch_size)
+
+        # terminal transitions get 0 before reaching 500 steps, and the reward otherwise
+        terminal_reward_weight = 1.0 if step >= 500 else 0.0
+
+        # compute the targets and perform a gradient descent for entire batch
+        loss = self._train_step([states, actions, rewards, next_states, dones, terminal_reward_weight])[0]
 
         # decaying epsilon-greedy probability
         self.epsilon = max(self.min_epsilon, self.epsilon*self.epsilon_decay)
-        self._log_scalar('epsilon', value=self.epsilon, step=total_step_number)
 
-    def _correct_state_size(self, state):
-        """
-        correct state size from (state_size,) to (1, state_size) for the network
-        """
-        return np.reshape(state, [1, self.state_size])
+        if total_step_number % self.steps_log_scalars == 0:
+            self._log_scalar('step loss', value=loss, step=total_step_number)
+            self._log_scalar('epsilon', value=self.epsilon, step=total_step_number)
 
     def train_agent(self,
                     episodes,
@@ -165,24 +334,36 @@ class DQNAgent:
         steps_till_update = 1  # count number of steps to update the target network
         total_steps = 1
 
+        # local bindings of the methods called on every step, saving their attribute lookups
+        env_step = self.env.step
+        sample_action = self._sample_action
+        store_transition = self._store_transition
+        replay = self._replay
+        sync_target = self._sync_target
+
         for i in range(1, episodes+1):
             start = time.time()
             # get initial state s
-            state = self._correct_state_size(self.env.reset())
+            state = np.asarray(self.env.reset(), dtype=np.float32)
+            self._store_state(state)
+
+            # pre-generate the random numbers of the 𝜀-greedy method for the whole episode
+            epsilon_rolls = np.random.random(steps_per_episode)
+            random_actions = np.random.randint(0, self.action_size, steps_per_episode)
 
             reward_in_episode = 0
             for step in range(1, steps_per_episode + 1):
                 # select action using 𝜀-greedy method
-                action = self._sample_action(state)
+                action = sample_action(state, epsilon_rolls[step - 1], random_actions[step - 1])
 
                 # execute action in emulator and observe reward, next state, and episode termination signal
-                next_state, reward, done, _ = self.env.step(action)
-                next_state = self._correct_state_size(next_state)
+                next_state, reward, done, _ = env_step(action)
+                next_state = np.asarray(next_state, dtype=np.float32)
 
                 reward_in_episode += reward
 
                 # store transition in replay memory
-                self.experience_replay.append((state, action, reward, next_state, done))
+                store_transition(action, reward, next_state, done)
 
                 # update current state to next state
                 state = next_state
@@ -192,21 +373,25 @@ class DQNAgent:
                     break
 
                 # sample random minibatch, update y, and perform gradient descent step
-                self._replay(batch_size, total_steps, step)
+                replay(batch_size, total_steps, step)
 
                 # every 'steps_update_target_model' steps, update target network (𝜃− <- 𝜃)
                 if steps_till_update % self.steps_update_target_model == 0:
-                    self.target_model.set_weights(self.q_value_model.get_weights())
+                    sync_target([])
                     steps_till_update = 1
 
                 steps_till_update += 1
                 total_steps += 1
 
             self._log_scalar('reward', value=reward_in_episode, step=i)
+            if len(self._last_100_rewards) == self._last_100_rewards.maxlen:
+                self._last_100_rewards_sum -= self._last_100_rewards[0]  # reward evicted by the append
             self._last_100_rewards.append(reward_in_episode)
-            avg100 = statistics.mean(self._last_100_rewards)
+            self._last_100_rewards_sum += reward_in_episode
+            avg100 = self._last_100_rewards_sum / len(self._last_100_rewards)
 
             self._log_scalar('avg 100 reward', value=avg100, step=i)
+            self._log_weights(step=i)
             end = time.time()
             print(f'Episode Reward: {reward_in_episode} Reward of last 100 episodes: {avg100:.2f}, Time: {(end-start):.2f}')
 
@@ -216,13 +401,13 @@ class DQNAgent:
         :param episodes: number of episodes
         """
         for _ in range(episodes):
-            state = self.env.reset()
+            state = np.asarray(self.env.reset(), dtype=np.float32)
             done = False
 
             while not done:
-                state = self._correct_state_size(state)
-                action = np.argmax(self.q_value_model.predict(state)[0])
+                action = int(self._greedy_action([state[None, :]])[0][0])
                 state, reward, done, _ = self.env.step(action)
+                state = np.asarray(state, dtype=np.float32)
                 self.env.render()
         self.env.close()
 
@@ -231,8 +416,29 @@ class DQNAgent:
                                                      simple_value=value)])
         self._file_writer.add_summary(summary, step)
 
+    def _log_histogram(self, tag, values, step, bins=100):
+        counts, bin_edges = np.histogram(values, bins=bins)
+        histogram = tf.HistogramProto(min=float(np.min(values)),
+                                      max=float(np.max(values)),
+                                      num=int(values.size),
+                                      sum=float(np.sum(values)),
+                                      sum_squares=float(np.sum(values ** 2)))
+        histogram.bucket_limit.extend(bin_edges[1:])
+        histogram.bucket.extend(counts)
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag,
+                                                     histo=histogram)])
+        self._file_writer.add_summary(summary, step)
+
+    def _log_weights(self, step):
+        """
+        log a histogram of each weight of the q-value model, once per episode
+        """
+        for weight, values in zip(self.q_value_model.weights, self.q_value_model.get_weights()):
+            self._log_histogram(weight.name, values=values, step=step)
+
 
 if __name__ == '__main__':
+    configure_session()
     cartpole_env = gym.make("CartPole-v1").env
 
     agent = DQNAgent(env=cartpole_env)